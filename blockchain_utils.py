@@ -1,9 +1,31 @@
 
 #helper functions for zimcoin blockchain
 
+import functools
+import hashlib
+import struct
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec, utils
 from cryptography.hazmat.primitives import serialization
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+
+#optional libsecp256k1 bindings, verifying secp256k1 signatures much faster than OpenSSL's generic elliptic curve code
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+#signature algorithm of transaction signatures (ECDSA over a prehashed SHA256 message), built once and shared by signing and verification
+SHA256_PREHASHED_ECDSA = ec.ECDSA(utils.Prehashed(hashes.SHA256()))
+
+#encoding of the transaction amount, fee and nonce as 8-byte little endian integers (precompiled format)
+TRANSACTION_FIELDS = struct.Struct('<QQQ')
+
+#length of the DER (SubjectPublicKeyInfo) serialization of an uncompressed secp256k1 public key
+SECP256K1_PUBLIC_KEY_DER_LENGTH = 88
+
+#order of the secp256k1 group
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 
 #--------------------------------------------
 ##### BLOCKCHAIN HELPER FUNCTIONS #####
@@ -54,36 +76,45 @@ def generate_address(public_key):
     #encode public key
     encoded_public_key = pk_serialize(public_key, encode_type = 'ser')
 
-    #generate address
-    address_digest = hashes.Hash(hashes.SHA1())
-    address_digest.update(encoded_public_key)
-    address_hash = address_digest.finalize()
+    #generate address (only canonical-length keys are cached, so that arbitrarily long keys received from peers cannot fill the cache)
+    if len(encoded_public_key) == SECP256K1_PUBLIC_KEY_DER_LENGTH:
+        address_hash = _pk_to_address(encoded_public_key)
+    else:
+        address_hash = hashlib.sha1(encoded_public_key).digest()
 
     return address_hash
 
+@functools.lru_cache(maxsize = 8192)
+def _pk_to_address(encoded_public_key):
+    '''
+    SHA1 hash of a DER-encoded secp256k1 public key, cached as the same senders are verified repeatedly (blocks, mempool re-validation, reorgs).
+    Bounded to 8192 keys of SECP256K1_PUBLIC_KEY_DER_LENGTH bytes (see generate_address).
+    '''
+
+    return hashlib.sha1(encoded_public_key).digest()
+
 #----------------------------------------------------------------------
 
-def sha256_hash(message_components: list, finalize = True):
+def sha256_hash(*message_components, finalize = True):
     '''
     Generate the SHA256 hash of a message.
 
     PARAMETERS:
-    message_components (list) - list of components to be added to the digest (in bytes)
+    *message_components - components to be added to the digest (in bytes), passed as separate arguments
     finalize - True to return full hash; False to return unfinalized digest
 
     OUTPUT:
     SHA256 hash (bytes) of message components
     '''
 
-    digest = hashes.Hash(hashes.SHA256())
+    digest = hashlib.sha256()
 
-    #if component is an integer it is converted to bytes of length 8 via little endian encoding
+    #components are not type-checked here (hot path); hashlib raises TypeError for components that are not bytes-like
     for e in message_components:
-        assert type(e) == bytes, f'{e} must be of type bytes'
         digest.update(e)
     
     if finalize: 
-        msg_hash = digest.finalize() 
+        msg_hash = digest.digest() 
         return msg_hash
     else:
         return digest
@@ -91,6 +122,25 @@ def sha256_hash(message_components: list, finalize = True):
 
 #----------------------------------------------------------------------
 
+def generate_message_hash(recipient_hash, amount, fee, nonce):
+    '''
+    Generate the SHA256 hash of a transaction message (the prehashed message signed by the sender).
+
+    PARAMETERS:
+    recipient_hash (bytes) - recipient address (SHA1 hash of recipient's public key)
+    amount (int) - transaction amount
+    fee (int) - transaction fee
+    nonce (int) - transaction sequence number
+
+    OUTPUT:
+    SHA256 hash (bytes) of transaction message
+    '''
+
+    #amount, fee and nonce are encoded as 8-byte little endian integers, packed together in one buffer
+    return sha256_hash(recipient_hash, TRANSACTION_FIELDS.pack(amount, fee, nonce))
+
+#----------------------------------------------------------------------
+
 def generate_signature(sender_secret_key, recipient_hash, amount, fee, nonce):
     '''
     Generate transaction message SHA256 hash and sign with sender's secret key.
@@ -107,9 +157,79 @@ def generate_signature(sender_secret_key, recipient_hash, amount, fee, nonce):
     '''
 
     #produce SHA256 hash of transaction message
-    msg_hash = sha256_hash([recipient_hash, amount.to_bytes(8,'little'), fee.to_bytes(8,'little'), nonce.to_bytes(8,'little')])
+    msg_hash = generate_message_hash(recipient_hash, amount, fee, nonce)
 
     #generate ECDSA signature of prehashed message using sender's secret key
-    signature = sender_secret_key.sign(msg_hash, ec.ECDSA(utils.Prehashed(hashes.SHA256()))) 
+    signature = sender_secret_key.sign(msg_hash, SHA256_PREHASHED_ECDSA)
+
+    return signature
+
+#----------------------------------------------------------------------
+
+def load_verifying_key(public_key):
+    '''
+    Decode a public key into the key object verify_ecdsa_signature verifies with: a coincurve PublicKey when coincurve is installed, a cryptography public key otherwise.
+    Keeping the result avoids decoding and converting the key again for every signature verified with it.
+    Keys other than secp256k1 elliptic curve keys are rejected on both backends, so that the validity of a signature never depends on whether coincurve is installed.
+
+    PARAMETERS:
+    public_key (bytes or unencoded) - DER-serialized or unencoded elliptic curve (secp256k1) public key
+
+    OUTPUT:
+    verifying key
+
+    RAISES:
+    ValueError if public_key is not a (DER-encoded) secp256k1 elliptic curve public key
+    '''
+
+    try:
+        public_key = pk_serialize(public_key, encode_type = 'des')
+    except UnsupportedAlgorithm:
+        raise ValueError('Public key should be a secp256k1 elliptic curve public key')
+    if not (isinstance(public_key, ec.EllipticCurvePublicKey) and isinstance(public_key.curve, ec.SECP256K1)):
+        raise ValueError('Public key should be a secp256k1 elliptic curve public key')
+
+    if coincurve is None:
+        return public_key
+
+    point = public_key.public_bytes(encoding=serialization.Encoding.X962, format=serialization.PublicFormat.UncompressedPoint)
+    return coincurve.PublicKey(point)
+
+#----------------------------------------------------------------------
+
+def verify_ecdsa_signature(public_key, signature, msg_hash):
+    '''
+    Verify the ECDSA signature of a prehashed message, using libsecp256k1 (coincurve) when it is installed and cryptography otherwise.
+
+    PARAMETERS:
+    public_key (unencoded) - elliptic curve (secp256k1) public key of the signer, or its verifying key from load_verifying_key
+    signature (bytes) - DER-encoded ECDSA signature
+    msg_hash (32 bytes) - SHA256 hash of the signed message
+
+    OUTPUT:
+    True if the signature is valid, False otherwise (no exception is raised for invalid signatures)
+
+    RAISES:
+    ValueError if public_key is not a secp256k1 elliptic curve public key (see load_verifying_key)
+    '''
 
-    return signature
\ No newline at end of file
+    if coincurve is None or not isinstance(public_key, coincurve.PublicKey):
+        public_key = load_verifying_key(public_key)
+
+    if coincurve is None:
+        try:
+            public_key.verify(signature, msg_hash, SHA256_PREHASHED_ECDSA)
+        except InvalidSignature:
+            return False
+        return True
+
+    #libsecp256k1 only accepts low-S signatures whereas OpenSSL accepts (and signs with) both forms, so high S values are normalized first
+    try:
+        r, s = utils.decode_dss_signature(signature)
+        if SECP256K1_ORDER // 2 < s < SECP256K1_ORDER:
+            signature = utils.encode_dss_signature(r, SECP256K1_ORDER - s)
+
+        return public_key.verify(signature, msg_hash, hasher = None)
+    except ValueError:
+        #signature is not valid DER
+        return False
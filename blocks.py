@@ -1,11 +1,20 @@
 #creates and updates user states and blocks for the zimcoin blockchain
 
 from blockchain_utils import *
-from collections import defaultdict
+from transactions import verify_signatures
 from itertools import count
-import copy
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import struct
+import os
 from time import time
 
+#difficulty from which mining is sharded across processes (below it the process start-up cost outweighs the speedup)
+PARALLEL_MINING_DIFFICULTY = 2**20
+
+#little endian encoding of the 8-byte nonce (packed into a reusable buffer in the mining loops)
+_NONCE_STRUCT = struct.Struct('<Q')
+
 #--------------------------------------------
 ##### USER STATE CLASS #####
 #--------------------------------------------
@@ -19,6 +28,9 @@ class UserState:
     2. earn method to updated user balance with earned coins
     3. spend method to updated user balance and nonce when making transactions
     '''
+
+    #fixed attribute slots (no per-instance __dict__) keep the many user states compact and speed up attribute access
+    __slots__ = ('balance', 'nonce')
     
     def __init__(self, balance, nonce): 
         '''
@@ -111,6 +123,41 @@ class Block:
         self.block_id = block_id
         self.nonce = nonce
 
+        #header fields, header prefix and unfinalized header digest, built on first use and reused while the header fields are unchanged (see _header)
+        self._header_cache = None
+
+    def _header(self):
+        '''
+        Concatenate the block header components hashed ahead of the nonce (previous, miner, transaction_ids, timestamp, difficulty) and digest them.
+        The single definition of the header layout, shared by block verification and the (serial and parallel) miners.
+        Both are cached together with the header fields they were built from, and rebuilt whenever those fields have changed,
+        so that re-verifying a block (e.g. on reorgs) skips the txid join and header hash while a verified block ID always matches the data being verified.
+
+        RETURNS:
+        header prefix (bytes) and its unfinalized SHA256 digest (copy it before updating it with a nonce)
+        '''
+
+        txids = [t.txid for t in self.transactions]
+        header_fields = (self.previous, self.miner, txids, self.timestamp, self.difficulty)
+
+        if self._header_cache is None or self._header_cache[0] != header_fields:
+            txid_blob = b''.join(txids)
+            header_prefix = b''.join([self.previous, self.miner, txid_blob, self.timestamp.to_bytes(8,'little'), self.difficulty.to_bytes(16,'little')])
+            self._header_cache = (header_fields, header_prefix, sha256_hash(header_prefix, finalize = False))
+
+        return self._header_cache[1], self._header_cache[2]
+
+    def _touched_users(self):
+        '''
+        Return the set of users whose state is changed by the block: the miner, and the senders and recipients of its transactions.
+        '''
+
+        touched_users = {self.miner}
+        for t in self.transactions:
+            touched_users.add(t.sender_hash)
+            touched_users.add(t.recipient_hash)
+        return touched_users
+
     def update_states(self,  previous_user_states: dict, mining_reward = 10000):
             '''
             Updates user states dictionary with new transactions.
@@ -124,27 +171,37 @@ class Block:
             '''
             
             #create updated_user_states dict as copy of previous_user_states (so as not to overwrite old states)
-            updated_user_states = defaultdict(lambda: UserState(0,-1), previous_user_states) 
-                #default value is an intial state with balance = 0 and nonce = -1 (set when called user does not exist in dict)
+            updated_user_states = dict(previous_user_states)
+
+            #replace the states of the users touched by the block with copies, so that UserState objects shared with previous_user_states are never modified
+            #users that do not exist in the dict get an intial state with balance = 0 and nonce = -1
+            for user in self._touched_users():
+                state = updated_user_states.get(user)
+                updated_user_states[user] = UserState(0,-1) if state is None else UserState(state.balance, state.nonce)
+
+            #verify transaction signatures as a batch (they do not depend on the user states), stopping at the first failure
+            assert verify_signatures(self.transactions)
 
             #miner reward
-            updated_user_states[self.miner].balance = updated_user_states[self.miner].earn(mining_reward)
+            #(the states are updated in place on the copies made above; looking each state up once per transaction keeps the loop lean)
+            miner_state = updated_user_states[self.miner]
+            miner_state.balance += mining_reward
 
             #updated user states with each transaction
             for t in self.transactions:
-                #verify transaction before updating states
-                sender_balance = updated_user_states[t.sender_hash].balance 
-                sender_previous_nonce = updated_user_states[t.sender_hash].nonce 
-                assert t.verify(sender_balance, sender_previous_nonce)
+                #verify transaction amount, fee and nonce before updating states
+                sender_state = updated_user_states[t.sender_hash]
+                assert t.verify_balance_nonce(sender_state.balance, sender_state.nonce)
 
                 #miner fee
-                updated_user_states[self.miner].balance = updated_user_states[self.miner].earn(t.fee)
+                miner_state.balance += t.fee
 
                 #update spender state
-                updated_user_states[t.sender_hash].balance, updated_user_states[t.sender_hash].nonce = updated_user_states[t.sender_hash].spend(t.amount)
+                sender_state.balance -= t.amount
+                sender_state.nonce += 1
 
                 #update recipient state
-                updated_user_states[t.recipient_hash].balance = updated_user_states[t.recipient_hash].earn(t.amount - t.fee)
+                updated_user_states[t.recipient_hash].balance += t.amount - t.fee
 
             return updated_user_states
         
@@ -166,8 +223,9 @@ class Block:
             assert self.difficulty == difficulty, 'Incorrect difficulty - difficulty of block should match the difficulty argument'
 
             #verify block_id
-            transaction_ids = b''.join([t.txid for t in self.transactions])
-            assert self.block_id == sha256_hash([self.previous, self.miner, transaction_ids, self.timestamp.to_bytes(8,'little'), difficulty.to_bytes(16,'little'), self.nonce.to_bytes(8,'little')]), 'Block ID does not correspond to the SHA256 hash of the block header components: previous, miner, transaction_ids, timestamp, difficulty, nonce'
+            block_digest = self._header()[1].copy()
+            block_digest.update(self.nonce.to_bytes(8,'little'))
+            assert self.block_id == block_digest.digest(), 'Block ID does not correspond to the SHA256 hash of the block header components: previous, miner, transaction_ids, timestamp, difficulty, nonce'
 
             #verify transactions list
             assert len(self.transactions) <= 25, 'Block can only contain at most 25 transactions'
@@ -176,7 +234,7 @@ class Block:
             assert len(self.miner) == 20, 'Miner hash should be 20 bytes long'
 
             #verify proof-of-work
-            assert int.from_bytes(self.block_id, "big") <= (2**256)/self.difficulty, 'Invalid proof of work - block ID should be small enough to match block difficulty'
+            assert self.block_id <= _target_bytes((2**256)/self.difficulty), 'Invalid proof of work - block ID should be small enough to match block difficulty'
 
             #update user states
             updated_user_states = self.update_states(previous_user_states) 
@@ -202,8 +260,12 @@ class Block:
         dictionary of user states with changes undone
         '''            
 
-        #create undone_user_states dict as copy of user_states_after (use deepcopy as .copy() also manipulates original dict)
-        undone_user_states = copy.deepcopy(user_states_after) 
+        #create undone_user_states dict as copy of user_states_after, copying only the states touched by the block (so as not to overwrite the states after)
+        undone_user_states = dict(user_states_after)
+        for user in self._touched_users():
+            state = undone_user_states[user]
+            undone_user_states[user] = UserState(state.balance, state.nonce)
+
         #miner reward
         undone_user_states[self.miner].balance = undone_user_states[self.miner].earn(mining_reward, undo = True)
 
@@ -226,6 +288,16 @@ class Block:
 ##### BLOCK MINING FUNCTIONS #####
 #--------------------------------------------       
 
+def _target_bytes(target):
+    '''
+    Encode a puzzle target as 32 big endian bytes, so that candidate block ids can be compared to it directly
+    (byte-wise comparison of equal length big endian encodings matches integer comparison).
+    '''
+
+    return min(int(target), 2**256 - 1).to_bytes(32, 'big')
+
+#----------------------------------------------------------------------
+
 def puzzle_solver(block_description, target):
     '''
     Find a nonce that when hashed to block_description produces a hash less than or equal to the target. 
@@ -238,21 +310,130 @@ def puzzle_solver(block_description, target):
     Nonce (int) that solves puzzle  
     '''
 
+    #bind the methods used in the loop to local names (avoids repeated attribute lookups on every candidate)
+    #copying block_description clones the SHA256 midstate, so only the final block containing the nonce is hashed per candidate
+    copy_description = block_description.copy
+    target_bytes = _target_bytes(target)
+    #the candidate nonce is packed in place into one buffer rather than allocating new bytes on every candidate
+    nonce_buffer = bytearray(8)
+    pack_nonce = _NONCE_STRUCT.pack_into
+
     for candidate_nonce in count():
         #itertools.count() generates an infinite sequence of integers starting from 0
 
-        candidate_digest = block_description.copy()
-        candidate_digest.update(candidate_nonce.to_bytes(8, 'little'))
-        candidate_solution = candidate_digest.finalize()
+        candidate_digest = copy_description()
+        pack_nonce(nonce_buffer, 0, candidate_nonce)
+        candidate_digest.update(nonce_buffer)
+        candidate_solution = candidate_digest.digest()
 
-        if int.from_bytes(candidate_solution, "big") <= target:
-            #for puzzle solving the candidate block id is encoded as a big endian integer
+        if candidate_solution <= target_bytes:
+            #for puzzle solving the candidate block id is compared as a big endian integer
             break
     
     return candidate_nonce
 
 #----------------------------------------------------------------------
 
+#start method of the mining worker processes: forking the multi-threaded node process (e.g. from the miner actor thread) can deadlock
+_mining_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+#(number of workers, process pool, shared solution event), created on first parallel mining and reused across blocks
+_mining_pool = None
+
+#event shared by the mining worker processes, set by the first worker that solves the puzzle
+_solution_found = None
+
+def _init_mining_worker(solution_found):
+    '''
+    Initializer of the mining worker processes; stores the shared solution event.
+    '''
+
+    global _solution_found
+    _solution_found = solution_found
+
+def _solve_nonce_shard(block_prefix, target, worker_id, num_workers):
+    '''
+    Search the nonces worker_id, worker_id + num_workers, worker_id + 2*num_workers, ... for a puzzle solution.
+
+    PARAMETERS:
+    block_prefix (bytes) - concatenated block attributes: previous, miner, transaction_ids, timestamp, difficulty
+    target (int) - puzzle target
+    worker_id (int) - index of the worker (first nonce tried)
+    num_workers (int) - number of workers (step between nonces tried)
+
+    OUTPUT:
+    Nonce (int) that solves puzzle, or None if another worker found a solution first
+    '''
+
+    copy_description = sha256_hash(block_prefix, finalize = False).copy
+    target_bytes = _target_bytes(target)
+    nonce_buffer = bytearray(8)
+    pack_nonce = _NONCE_STRUCT.pack_into
+
+    for i, candidate_nonce in enumerate(range(worker_id, 2**64, num_workers)):
+
+        candidate_digest = copy_description()
+        pack_nonce(nonce_buffer, 0, candidate_nonce)
+        candidate_digest.update(nonce_buffer)
+
+        if candidate_digest.digest() <= target_bytes:
+            _solution_found.set()
+            return candidate_nonce
+
+        #poll the shared event periodically and stop once another worker has solved the puzzle
+        if i % 4096 == 0 and _solution_found.is_set():
+            return None
+
+def _get_mining_pool(num_workers):
+    '''
+    Return the process pool and solution event of the mining workers, starting them on first use (or when the number of workers changes),
+    so that the worker start-up cost is paid once rather than for every mined block.
+    '''
+
+    global _mining_pool
+
+    if _mining_pool is None or _mining_pool[0] != num_workers:
+        if _mining_pool is not None:
+            _mining_pool[1].shutdown()
+        solution_found = _mining_context.Event()
+        executor = ProcessPoolExecutor(max_workers = num_workers, mp_context = _mining_context, initializer = _init_mining_worker, initargs = (solution_found,))
+        _mining_pool = (num_workers, executor, solution_found)
+
+    return _mining_pool[1], _mining_pool[2]
+
+def parallel_puzzle_solver(block_prefix, target, num_workers = None):
+    '''
+    Find a nonce solving the puzzle by sharding the nonce space across worker processes.
+
+    PARAMETERS:
+    block_prefix (bytes) - concatenated block attributes: previous, miner, transaction_ids, timestamp, difficulty
+    target (int) - puzzle target
+    num_workers (int) - number of worker processes (defaults to the number of CPUs)
+
+    OUTPUT:
+    Nonce (int) that solves puzzle
+    '''
+
+    num_workers = num_workers or os.cpu_count() or 1
+    executor, solution_found = _get_mining_pool(num_workers)
+    solution_found.clear()
+
+    pending = {executor.submit(_solve_nonce_shard, block_prefix, target, worker_id, num_workers) for worker_id in range(num_workers)}
+    try:
+        #return the first solution found; the remaining workers exit once they see the event set
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                nonce = future.result()
+                if nonce is not None:
+                    return nonce
+    finally:
+        #stop the workers still searching and wait for them, so that the reused pool is idle for the next block
+        solution_found.set()
+        wait(pending)
+
+#----------------------------------------------------------------------
+
 def mine_block(previous, height, miner, transactions, timestamp, difficulty, hashrate = time() + 100):
     '''
 
@@ -266,18 +447,21 @@ def mine_block(previous, height, miner, transactions, timestamp, difficulty, has
     hashrate (int) - mining speed
     '''
 
-    #generate block description
-    transaction_ids = b''.join([t.txid for t in transactions]) #concatenate transaction id's (bytes) in block
-    block_description = sha256_hash([previous, miner, transaction_ids, timestamp.to_bytes(8,'little'), difficulty.to_bytes(16,'little')], finalize = False) #return the description digest
+    #create Block instance (block id and nonce are set once the puzzle is solved)
+    block = Block(previous, height, miner, transactions, timestamp, difficulty, None, None)
 
-    #proof-of-work 
+    #proof-of-work (sharded across processes for high difficulties)
+    block_prefix, block_description = block._header()
     target = (2**256)/difficulty
-    nonce = puzzle_solver(block_description, target)
+    if difficulty < PARALLEL_MINING_DIFFICULTY:
+        nonce = puzzle_solver(block_description, target)
+    else:
+        nonce = parallel_puzzle_solver(block_prefix, target)
 
     #combine nonce solution with block description to form block id
-    block_id = sha256_hash([previous, miner, transaction_ids, timestamp.to_bytes(8,'little'), difficulty.to_bytes(16,'little'), nonce.to_bytes(8,'little')])
-
-    #create Block instance
-    block = Block(previous, height, miner, transactions, timestamp, difficulty, block_id, nonce)
+    block_digest = block_description.copy()
+    block_digest.update(nonce.to_bytes(8,'little'))
+    block.block_id = block_digest.digest()
+    block.nonce = nonce
 
     return block
@@ -1,7 +1,6 @@
 #updates blockchain state for the zimcoin blockchain
 
 from blocks import *
-import copy
 
 #--------------------------------------------
 ##### BLOCKCHAIN STATE CLASS #####
@@ -34,6 +33,9 @@ class BlockchainState:
         self.user_states = user_states
         self.total_difficulty = total_difficulty
 
+        #(block id of the chain tip, difficulty) from the last calculate_difficulty call on a chain longer than 10 blocks
+        self._difficulty_cache = None
+
     def calculate_difficulty(self):
         '''
         Adjust mining difficulty based on rate at which blocks are produced.
@@ -52,6 +54,11 @@ class BlockchainState:
         
         else:
 
+            #reuse the difficulty calculated for the same chain tip (the block id commits to the whole chain)
+            tip_block_id = self.longest_chain[-1].block_id
+            if self._difficulty_cache is not None and self._difficulty_cache[0] == tip_block_id:
+                return self._difficulty_cache[1]
+
             #calculate total difficulty of last 10 blocks
             total_difficulty_for_period = 0
             for block in self.longest_chain[-10::]:
@@ -68,6 +75,7 @@ class BlockchainState:
 
             #calculate updated difficulty
             updated_difficulty = (total_difficulty_for_period // total_time_for_period) * 120
+            self._difficulty_cache = (tip_block_id, updated_difficulty)
             return updated_difficulty
 
     def verify_and_apply_block(self, block):
@@ -149,9 +157,10 @@ def verify_reorg(old_state, new_branch):
     new BlockchainState object with new_branch if valid
     '''
 
-    #initiate new chain state starting from old_state (use deepcopy as .copy() also manipulates original dict)
-    start_chain = copy.deepcopy(old_state.longest_chain)
-    start_states = copy.deepcopy(old_state.user_states)
+    #initiate new chain state starting from old_state
+    #(shallow copies are enough: the reorg only pops/appends blocks, and blocks never modify UserState objects in place)
+    start_chain = list(old_state.longest_chain)
+    start_states = dict(old_state.user_states)
     new_state = BlockchainState(start_chain, start_states, old_state.total_difficulty)
 
     split_height = new_branch[0].height #height at which new branch splits from old chain
@@ -1,7 +1,7 @@
 from typing import Optional, List, Dict
 
 from blocks import UserState
-from transactions import Transaction
+from transactions import Transaction, verify_many
 
 MAX_TRANSACTIONS = 50
 
@@ -37,15 +37,16 @@ class Mempool:
             return False
 
     def filter(self, user_states: Dict[bytes, UserState]):
+        transactions = list(self.by_sender.values())
+        states = [user_states.get(transaction.sender_hash, UserState(0, -1)) for transaction in transactions]
+        valid = verify_many(transactions, [state.balance for state in states], [state.nonce for state in states])
+
         new_transactions = dict()
-        for transaction in self.by_sender.values():
-            try:
-                state = user_states[transaction.sender_hash]
-                transaction.verify(state.balance, state.nonce)
-            except:
-                print("Removing transaction", transaction.txid, "from mempool")
-            else:
+        for transaction, is_valid in zip(transactions, valid):
+            if is_valid:
                 new_transactions[transaction.sender_hash] = transaction
+            else:
+                print("Removing transaction", transaction.txid, "from mempool")
         self.by_sender = new_transactions
 
     def get_transactions(self) -> List[Transaction]:
@@ -3,10 +3,10 @@ from typing import List, Optional, Dict
 from pykka import ActorRef, ThreadingActor
 
 from chain import BlockchainState, verify_reorg
-from blocks import Block
+from blocks import Block, UserState
 from mempool import Mempool
 from persistence import Persistence
-from transactions import Transaction
+from transactions import Transaction, verify_many
 
 
 class NodeStateSummary:
@@ -118,15 +118,13 @@ class Node(ThreadingActor):
 
     def received_transactions(self, transactions: List[Transaction]):
         accepted_transactions = []
-        for transaction in transactions:
-            try:
-                sender_state = self.blockchain_state.user_states.get(transaction.sender_hash)
-                transaction.verify(sender_state.balance, sender_state.nonce)
-            except:
+        sender_states = [self.blockchain_state.user_states.get(transaction.sender_hash, UserState(0, -1)) for transaction in transactions]
+        valid = verify_many(transactions, [state.balance for state in sender_states], [state.nonce for state in sender_states])
+        for transaction, is_valid in zip(transactions, valid):
+            if not is_valid:
                 print("Transaction", transaction.txid, "failed verification")
-            else:
-                if self.mempool.add_transaction(transaction):
-                    accepted_transactions.append(transaction)
+            elif self.mempool.add_transaction(transaction):
+                accepted_transactions.append(transaction)
 
         if len(accepted_transactions) > 0:
             for connection in self.connections:
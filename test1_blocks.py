@@ -3,6 +3,7 @@
 from blocks import *
 from transactions import *
 from blockchain_utils import *
+import blockchain_utils
 import time
 from cryptography.hazmat.primitives.asymmetric import ec
 import unittest
@@ -53,6 +54,116 @@ class BlocksTest(unittest.TestCase):
         states = block_1.verify_and_get_changes(100, initial_states)
         self.assertEqual(states[alice_address].balance, 1000 + 10_000 - 500 + 300 + 10)
         self.assertEqual(states[bob_address].balance, 500 - 10 - 300)
+        self.assertEqual(initial_states[alice_address].balance, 1000)
+        self.assertEqual(initial_states[alice_address].nonce, 4)
+
+    def test_malformed_transaction_in_block(self):
+        alice = ec.generate_private_key(ec.SECP256K1)
+        alice_public_key = pk_serialize(alice.public_key())
+        alice_address = generate_address(alice_public_key)
+
+        #state-independent field checks fail with their description before the fields are packed for hashing
+        transaction_1 = Transaction(alice_address, bytes(20), alice_public_key, 500, -1, 0, bytes(70), bytes(32))
+        block_1 = mine_block(bytes(32), 0, alice_address, [transaction_1], int(time.time()), 100)
+        with self.assertRaisesRegex(AssertionError, "Fee \\(-1\\) should range between zero and amount"):
+            block_1.verify_and_get_changes(100, dict([(alice_address, UserState(1000, -1))]))
+
+        transaction_1.fee, transaction_1.amount = 10, 500.0
+        block_1 = mine_block(bytes(32), 0, alice_address, [transaction_1], int(time.time()), 100)
+        with self.assertRaisesRegex(AssertionError, "should be whole number"):
+            block_1.verify_and_get_changes(100, dict([(alice_address, UserState(1000, -1))]))
+
+    def test_modified_block(self):
+        alice = ec.generate_private_key(ec.SECP256K1)
+        alice_address = generate_address(alice.public_key())
+        bob_address = generate_address(ec.generate_private_key(ec.SECP256K1).public_key())
+
+        #changing the header fields of a mined block invalidates its block ID
+        block_1 = mine_block(bytes(32), 0, alice_address, [], int(time.time()), 100)
+        block_1.timestamp += 1
+        block_1.transactions = [create_signed_transaction(alice, bob_address, 10, 5, 0)]
+        with self.assertRaisesRegex(Exception, "Block ID"):
+            block_1.verify_and_get_changes(100, dict([(alice_address, UserState(1000, -1))]))
+
+    def test_verify_bool(self):
+        alice = ec.generate_private_key(ec.SECP256K1)
+        bob_address = generate_address(ec.generate_private_key(ec.SECP256K1).public_key())
+
+        transaction = create_signed_transaction(alice, bob_address, 500, 10, 5)
+        self.assertEqual(transaction.sender_public_key, pk_serialize(alice.public_key()))
+        self.assertTrue(transaction.verify_bool(1000, 4))
+        self.assertFalse(transaction.verify_bool(499, 4))
+        self.assertFalse(transaction.verify_bool(1000, 5))
+        self.assertEqual(verify_many([transaction, transaction, transaction], [1000, 499, 1000], [4, 4, 5]), [True, False, False])
+
+        #a malformed transaction is reported as invalid without aborting the rest of the batch
+        malformed = create_signed_transaction(alice, bob_address, 500, 10, 5)
+        malformed.recipient_hash = None
+        self.assertEqual(verify_many([malformed, transaction, transaction], [1000, 1000, 1000], [4, 4, 4]), [False, True, True])
+
+        #changing a field after verification invalidates the encodings cached from its old value
+        transaction.amount = 900
+        self.assertFalse(transaction.verify_bool(1000, 4))
+        transaction.amount = 500
+        self.assertTrue(transaction.verify_bool(1000, 4))
+
+        transaction.signature = create_signed_transaction(alice, bob_address, 500, 10, 6).signature
+        self.assertFalse(transaction.verify_bool(1000, 4))
+
+    def test_verify_ecdsa_signature(self):
+        alice = ec.generate_private_key(ec.SECP256K1)
+        msg_hash = generate_message_hash(bytes(20), 500, 10, 0)
+        signature = generate_signature(alice, bytes(20), 500, 10, 0)
+        self.assertTrue(verify_ecdsa_signature(alice.public_key(), signature, msg_hash))
+        self.assertTrue(verify_ecdsa_signature(load_verifying_key(pk_serialize(alice.public_key())), signature, msg_hash))
+
+        #both the low-S and the high-S form of a signature are valid
+        r, s = utils.decode_dss_signature(signature)
+        self.assertTrue(verify_ecdsa_signature(alice.public_key(), utils.encode_dss_signature(r, SECP256K1_ORDER - s), msg_hash))
+
+        self.assertFalse(verify_ecdsa_signature(alice.public_key(), signature, generate_message_hash(bytes(20), 500, 10, 1)))
+        self.assertFalse(verify_ecdsa_signature(alice.public_key(), signature[:-1], msg_hash))
+
+    def test_non_secp256k1_public_key(self):
+        alice = ec.generate_private_key(ec.SECP256R1())
+        alice_public_key = pk_serialize(alice.public_key())
+        alice_address = generate_address(alice_public_key)
+        signature = generate_signature(alice, bytes(20), 500, 10, 0)
+        txid = sha256_hash(alice_address, bytes(20), alice_public_key, TRANSACTION_FIELDS.pack(500, 10, 0), signature)
+
+        #a correctly signed transaction with a key on another curve is invalid with and without coincurve
+        installed_coincurve = blockchain_utils.coincurve
+        try:
+            for backend in [installed_coincurve, None]:
+                blockchain_utils.coincurve = backend
+                transaction = Transaction(alice_address, bytes(20), alice_public_key, 500, 10, 0, signature, txid)
+                self.assertFalse(transaction.verify_bool(1000, -1))
+                with self.assertRaisesRegex(AssertionError, "secp256k1"):
+                    transaction.verify(1000, -1)
+        finally:
+            blockchain_utils.coincurve = installed_coincurve
+
+    def test_verify_signatures_failure_order(self):
+        alice = ec.generate_private_key(ec.SECP256K1)
+        alice_public_key = pk_serialize(alice.public_key())
+        alice_address = generate_address(alice_public_key)
+        carol = ec.generate_private_key(ec.SECP256R1())
+        carol_public_key = pk_serialize(carol.public_key())
+        carol_address = generate_address(carol_public_key)
+
+        #both transactions pass the cheap checks; one has another sender's signature, the other a key on another curve
+        signature = generate_signature(carol, bytes(20), 500, 10, 0)
+        wrong_curve = Transaction(carol_address, bytes(20), carol_public_key, 500, 10, 0, signature,
+                                  sha256_hash(carol_address, bytes(20), carol_public_key, TRANSACTION_FIELDS.pack(500, 10, 0), signature))
+        signature = generate_signature(ec.generate_private_key(ec.SECP256K1), bytes(20), 500, 10, 0)
+        wrong_signature = Transaction(alice_address, bytes(20), alice_public_key, 500, 10, 0, signature,
+                                      sha256_hash(alice_address, bytes(20), alice_public_key, TRANSACTION_FIELDS.pack(500, 10, 0), signature))
+
+        #the failure of the first failing transaction is raised
+        with self.assertRaisesRegex(AssertionError, "secp256k1"):
+            verify_signatures([wrong_curve, wrong_signature])
+        with self.assertRaises(InvalidSignature):
+            verify_signatures([wrong_signature, wrong_curve])
 
     def test_chain_1(self):
         chain = [
@@ -290,6 +401,12 @@ class BlocksTest(unittest.TestCase):
         with self.assertRaisesRegex(Exception, "Invalid proof of work"):
             check_chain(100_000, chain)
 
+    def test_parallel_puzzle_solver(self):
+        block_prefix = bytes(32) + bytes.fromhex('dca5d2f1d7c2fea3c4e5d07211d33e03b04b5b2c')
+        target = (2**256)/1000
+        nonce = parallel_puzzle_solver(block_prefix, target, num_workers = 2)
+        self.assertLessEqual(int.from_bytes(sha256_hash(block_prefix, nonce.to_bytes(8,'little')), "big"), target)
+
 #--------------------------------------------
 ##### RUNNING TESTS #####
 #--------------------------------------------
@@ -114,6 +114,18 @@ class BlockchainStateTest(unittest.TestCase):
 
         assert state.calculate_difficulty() == 1_200_000
 
+    def test_difficulty_after_undo(self):
+        state = BlockchainState([], dict(), 0)
+        previous = bytes([0] * 32)
+        for height in range(12):
+            block = mine_block(previous, height, ALICE_ADDRESS, [], 60 * height, state.calculate_difficulty(), time() + 100)
+            state.verify_and_apply_block(block)
+            previous = block.block_id
+
+        assert state.calculate_difficulty() == 2160
+        state.undo_last_block()
+        assert state.calculate_difficulty() == 1920
+
     def test_reorg(self):
 
         #generate original chain
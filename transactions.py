@@ -2,6 +2,17 @@
 
 from blockchain_utils import *
 from cryptography.exceptions import InvalidSignature
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+#failure description of a transaction whose ECDSA signature does not verify
+INVALID_SIGNATURE = 'Invalid Signature'
+
+#thread pool verifying transaction signatures (ECDSA verification runs in OpenSSL, releasing the GIL)
+_signature_executor = ThreadPoolExecutor(max_workers = os.cpu_count())
 
 #--------------------------------------------
 ##### TRANSACTIONS CLASS #####
@@ -14,8 +25,15 @@ class Transaction:
     METHODS:
     1. constructor function
     2. verify function to verify the transaction data
+    3. verify_bool function to verify the transaction data, returning False instead of raising on failure
+    4. verify_balance_nonce function to verify the amount, fee and nonce against the sender's state
+    5. verify_signature function to verify the amount, fee and nonce fields, the hashes, txid and signature
     '''
 
+    #fixed attribute slots (no per-instance __dict__) keep mempools of many transactions compact and speed up attribute access
+    __slots__ = ('sender_hash', 'recipient_hash', 'sender_public_key', 'amount', 'fee', 'nonce', 'signature', 'txid',
+                 '_msg_hash', '_decoded_pk')
+
     def __init__(self, sender_hash, recipient_hash, sender_public_key, amount, fee, nonce, signature, txid): 
         '''
         The constructor method for the Transaction class. The parameters are used to set the attributes of the class instance.
@@ -23,7 +41,7 @@ class Transaction:
         PARAMETERS:
         sender_hash (20 bytes) - SHA1 hash of sender's public key (i.e. sender address)
         recipient_hash (20 bytes) - SHA1 hash of recipient's public key (i.e. receiver address)
-        sender_public_key (unencoded or ~ 90 bytes) - elliptic curve (secp256k1) public key generated from sender's secret key
+        sender_public_key (~ 90 bytes) - DER-serialized elliptic curve (secp256k1) public key generated from sender's secret key (an unencoded key is serialized)
         amount (int) - amount to be transferred
         fee (int) - transaction fee
         nonce (int) - sender transaction sequence number
@@ -34,13 +52,36 @@ class Transaction:
         #defining the class instance attributes
         self.sender_hash = sender_hash #self = referring to the object instance itself; .sender_hash = object attribute
         self.recipient_hash = recipient_hash
-        self.sender_public_key = sender_public_key
+        self.sender_public_key = pk_serialize(sender_public_key) #stored DER-serialized, as hashed into the txid and sent over the wire
         self.amount = amount
         self.fee = fee
         self.nonce = nonce
         self.signature = signature
         self.txid = txid
 
+        #the caches below are stored with the field values they were built from, and rebuilt when those fields have been changed
+        #(recipient_hash, amount, fee, nonce) and the SHA256 hash of the signed transaction message, computed on first signature verification
+        self._msg_hash = None
+        #(sender_public_key, verifying key of the sender (see load_verifying_key)), decoded on first signature verification (or shared by the batch verification functions)
+        self._decoded_pk = None
+
+    @property
+    def packed_fields(self):
+        '''
+        Amount, fee and nonce encoded as 8-byte little endian integers (24 bytes).
+        Encoded on access rather than in the constructor, so that out-of-range fields fail verification instead of construction.
+        '''
+
+        return TRANSACTION_FIELDS.pack(self.amount, self.fee, self.nonce)
+
+
+    def _log_failure(self, error):
+        '''
+        Log a failed verification at debug level (the txid is only hex-encoded when debug logging is enabled).
+        '''
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Transaction %s unsuccesful: %s', self.txid.hex(), _error_text(error))
 
     def verify(self, sender_balance, sender_previous_nonce):
         '''
@@ -59,48 +100,312 @@ class Transaction:
         sender_previous_nonce (int) - nonce from previoius transaction by the spender
 
         '''
-        try:
-            #verify sender hash
-            assert len(self.sender_hash) == 20, 'Sender hash should should be 20 bytes long'
-            assert self.sender_hash == generate_address(self.sender_public_key), 'Sender hash be SHA1 hash of sender public key'
 
-            #verify recipient hash
-            assert len(self.recipient_hash) == 20, 'Recipient hash should should be 20 bytes long'
+        error = self._error(sender_balance, sender_previous_nonce)
+        if error is not None:
+            self._raise_failure(error)
+
+        return True
+
+    def verify_bool(self, sender_balance, sender_previous_nonce):
+        '''
+        Performs the same checks as verify, returning False on failure instead of raising an exception (cheaper for callers that only need pass/fail, e.g. the mempool).
+
+        PARAMETERS:
+        sender_balance (int) - spender funds available to spend
+        sender_previous_nonce (int) - nonce from previoius transaction by the spender
+
+        RETURNS:
+        True if the transaction is valid, False otherwise
+        '''
+
+        return self._error(sender_balance, sender_previous_nonce) is None
+
+    def verify_balance_nonce(self, sender_balance, sender_previous_nonce):
+        '''
+        Verifies the amount and nonce of a transaction against the sender's state.
+        The amount, fee and nonce fields themselves are checked by verify_signature, which should run first (as in Block.update_states).
+
+        PARAMETERS:
+        sender_balance (int) - spender funds available to spend
+        sender_previous_nonce (int) - nonce from previoius transaction by the spender
+
+        '''
+
+        error = self._balance_nonce_error(sender_balance, sender_previous_nonce)
+        if error is not None:
+            self._raise_failure(error)
+
+        return True
+
+    def verify_signature(self):
+        '''
+        Verifies the parts of a transaction that do not depend on the sender's state: the amount, fee and nonce fields, the sender and recipient hashes, the txid and the signature.
+        Safe to run concurrently for many transactions (the ECDSA verification runs in OpenSSL).
+
+        '''
+
+        error = self._signature_error()
+        if error is not None:
+            self._raise_failure(error)
+
+        return True
+
+    def _error(self, sender_balance, sender_previous_nonce):
+        '''
+        Runs all the checks of verify, each once and cheapest first: the amount, fee and nonce fields, the sender's state, the hashes and txid, then the signature.
+
+        RETURNS:
+        description (str or (template, *values) tuple) of the first failed check (INVALID_SIGNATURE for a bad signature), or None if all checks pass
+        '''
+
+        return (self._field_error() or self._balance_nonce_error(sender_balance, sender_previous_nonce)
+                or self._precheck_error() or self._ecdsa_error())
+
+    def _raise_failure(self, error):
+        '''
+        Log a failed check and raise its exception: InvalidSignature for a bad signature, AssertionError with the description otherwise.
+        '''
+
+        self._log_failure(error)
+        if error == INVALID_SIGNATURE:
+            raise InvalidSignature
+        raise AssertionError(_error_text(error)) #throw AssertionError exception (break the code runtime)
+
+    def _balance_nonce_error(self, sender_balance, sender_previous_nonce):
+        '''
+        Checks the amount and nonce of a transaction against the sender's state (the fields themselves are checked by _field_error, which runs first).
+
+        RETURNS:
+        description ((template, *values) tuple) of the first failed check, or None if all checks pass
+        '''
+
+        #verify amount
+        if self.amount > sender_balance:
+            return ('Balance too small - amount (%s) should be at most equal to sender_balance (%s)', self.amount, sender_balance)
+
+        #verify nonce
+        if self.nonce != sender_previous_nonce + 1:
+            return ('Invalid nonce - current nonce (%s) should be previous nonce (%s) incremented by 1', self.nonce, sender_previous_nonce)
+
+        return None
+
+    def _field_error(self):
+        '''
+        Checks the amount, fee and nonce of a transaction independently of the sender's state: they should be whole numbers that fit in 8 bytes,
+        with a positive amount and a fee between zero and amount.
+
+        RETURNS:
+        description (str or (template, *values) tuple) of the first failed check, or None if all checks pass
+        '''
 
-            #verify amount
-            assert self.amount % 1 == 0, f'Amount ({self.amount}) should be whole number' 
-            assert (self.amount > 0) and (self.amount <= (sender_balance)), f'Balance too small - amount ({self.amount}) should be positive and at most equal to sender_balance ({sender_balance})'
+        #verify amount
+        if not isinstance(self.amount, int):
+            return ('Amount (%s) should be whole number', self.amount)
+        if not (0 < self.amount < 2**64):
+            return ('Amount (%s) should be positive and less than 2**64', self.amount)
 
-            #verify fee
-            assert self.fee % 1 == 0 , f'Fee ({self.fee}) should be whole number' 
-            assert (self.fee >= 0) and (self.fee <= self.amount), f'Fee ({self.fee}) should range between zero and amount'
+        #verify fee
+        if not isinstance(self.fee, int):
+            return ('Fee (%s) should be whole number', self.fee)
+        if not ((self.fee >= 0) and (self.fee <= self.amount)):
+            return ('Fee (%s) should range between zero and amount', self.fee)
 
-            #verify nonce
-            assert self.nonce == sender_previous_nonce + 1, f'Invalid nonce - current nonce ({self.nonce}) should be previous nonce ({sender_previous_nonce}) incremented by 1'
+        #verify nonce
+        if not isinstance(self.nonce, int):
+            return ('Nonce (%s) should be whole number', self.nonce)
+        if not (0 <= self.nonce < 2**64):
+            return ('Nonce (%s) should be non-negative and less than 2**64', self.nonce)
 
-            #verify txid
-            assert self.txid == sha256_hash([self.sender_hash, self.recipient_hash, pk_serialize(self.sender_public_key), self.amount.to_bytes(8,'little'), self.fee.to_bytes(8,'little'), self.nonce.to_bytes(8,'little'), self.signature]), 'Transaction ID does not correspond to the hash of the transaction components: sender hash, recipient hash, sender public key, amount, fee, nonce, signature'
+        return None
 
-            #verify signature
+    def _signature_error(self):
+        '''
+        Checks the amount, fee and nonce fields, the sender and recipient hashes, the txid and the signature of a transaction.
+
+        RETURNS:
+        description (str or (template, *values) tuple) of the first failed check (INVALID_SIGNATURE for a bad signature), or None if all checks pass
+        '''
+
+        return self._field_error() or self._precheck_error() or self._ecdsa_error()
+
+    def _precheck_error(self):
+        '''
+        Checks the sender and recipient hashes and the txid of a transaction whose fields have passed _field_error:
+        the cheap part of _signature_error, run before the ECDSA verification.
+
+        RETURNS:
+        description (str or (template, *values) tuple) of the first failed check, or None if all checks pass
+        '''
+
+        #cheap length checks run before any hashing
+
+        #verify sender and recipient hash lengths
+        if len(self.sender_hash) != 20:
+            return 'Sender hash should should be 20 bytes long'
+        if len(self.recipient_hash) != 20:
+            return 'Recipient hash should should be 20 bytes long'
+
+        #verify sender hash
+        if self.sender_hash != generate_address(self.sender_public_key):
+            return 'Sender hash be SHA1 hash of sender public key'
+
+        #verify txid
+        if self.txid != sha256_hash(self.sender_hash, self.recipient_hash, self.sender_public_key, self.packed_fields, self.signature):
+            return 'Transaction ID does not correspond to the hash of the transaction components: sender hash, recipient hash, sender public key, amount, fee, nonce, signature'
+
+        return None
+
+    def _ecdsa_error(self):
+        '''
+        Checks the ECDSA signature of a transaction whose fields have passed _precheck_error.
+
+        RETURNS:
+        description (str) of the failed check (INVALID_SIGNATURE for a bad signature), or None if the signature is valid
+        '''
+
+        #verify signature
+
+        #generate a hash of the message supposed to have been signed (once per transaction, as it is re-verified by the mempool and on reorgs)
+        message_fields = (self.recipient_hash, self.amount, self.fee, self.nonce)
+        if self._msg_hash is None or self._msg_hash[0] != message_fields:
+            self._msg_hash = (message_fields, sha256_hash(self.recipient_hash, self.packed_fields)) #same message as generate_message_hash
+        msg_hash = self._msg_hash[1]
+        #deserialize public key into its verifying key
+        if self._decoded_pk is None or self._decoded_pk[0] != self.sender_public_key:
+            try:
+                self._decoded_pk = (self.sender_public_key, load_verifying_key(self.sender_public_key))
+            except ValueError:
+                return 'Sender public key should be a DER-encoded secp256k1 public key'
+        #verify that ECDSA signature was signed with sender's secret key on the hashed message by unlocking with the sender's public key
+        if not verify_ecdsa_signature(self._decoded_pk[1], self.signature, msg_hash):
+            return INVALID_SIGNATURE
+
+        return None
+
+def _error_text(error):
+    '''
+    Build the description of a failed check from a fixed description (str) or a (template, *values) tuple.
+    Checks return the tuple form for descriptions containing values, so that callers only needing pass/fail (verify_bool) never format them.
+    '''
+
+    if type(error) is tuple:
+        return error[0] % error[1:]
+    return error
+
+#--------------------------------------------
+##### BATCH VERIFICATION FUNCTIONS #####
+#--------------------------------------------
+
+def _share_decoded_public_keys(transactions):
+    '''
+    Decode the public key of each sender in a batch into its verifying key once, and share it between all of that sender's transactions
+    (a sender often has several transactions with consecutive nonces in a block or a mempool).
+    '''
+
+    decoded_public_keys = dict()
+    for t in transactions:
+        if t._decoded_pk is None or t._decoded_pk[0] != t.sender_public_key:
+            if t.sender_public_key not in decoded_public_keys:
+                try:
+                    decoded_public_keys[t.sender_public_key] = (t.sender_public_key, load_verifying_key(t.sender_public_key))
+                except ValueError:
+                    #left undecoded; the transaction's own verification reports the invalid key
+                    decoded_public_keys[t.sender_public_key] = None
+            t._decoded_pk = decoded_public_keys[t.sender_public_key]
+
+def _check_ecdsa(transaction):
+    '''
+    Raise the exception of a transaction whose ECDSA signature check fails (run on the thread pool).
+    '''
+
+    error = transaction._ecdsa_error()
+    if error is not None:
+        transaction._raise_failure(error)
+
+def verify_signatures(transactions):
+    '''
+    Verify the fields, hashes, txids and signatures of a batch of transactions (see Transaction.verify_signature).
+    The cheap checks run serially first; only the ECDSA verifications are spread over a thread pool.
+    Stops at the first failure and raises the exception of the lowest-index failing transaction.
+
+    PARAMETERS:
+    transactions (list) - transactions to verify
+
+    OUTPUT:
+    True if every transaction is valid
+    '''
+
+    for t in transactions:
+        error = t._field_error() or t._precheck_error()
+        if error is not None:
+            t._raise_failure(error)
+
+    _share_decoded_public_keys(transactions)
+    signature_checks = [_signature_executor.submit(_check_ecdsa, t) for t in transactions]
+    done, pending = wait(signature_checks, return_when = FIRST_EXCEPTION)
+    if pending:
+        #a check failed: cancel the checks after the first failure seen and let the earlier ones finish,
+        #so that the failure of the lowest-index transaction is raised whatever order the threads finish in
+        first_failure = min(i for i, check in enumerate(signature_checks) if check in done and check.exception() is not None)
+        for check in signature_checks[first_failure + 1:]:
+            check.cancel()
+        wait(signature_checks[:first_failure])
+    for check in signature_checks:
+        check.result()
+
+    return True
+
+def _passes_prechecks(transaction, sender_balance, sender_previous_nonce):
+    '''
+    Run the cheap checks of verify_bool (balance, nonce, fields, hashes, txid) on one transaction of a batch.
+    An unexpected exception (e.g. a malformed field received from a peer) counts as a failed check, so that it cannot abort the rest of the batch.
+    '''
+
+    try:
+        return (transaction._field_error() or transaction._balance_nonce_error(sender_balance, sender_previous_nonce) or transaction._precheck_error()) is None
+    except Exception:
+        log.debug('Transaction check raised an exception', exc_info = True)
+        return False
+
+def _passes_ecdsa(transaction):
+    '''
+    Run the ECDSA check of verify_bool on one transaction of a batch, counting an unexpected exception as a failed check (see _passes_prechecks).
+    '''
+
+    try:
+        return transaction._ecdsa_error() is None
+    except Exception:
+        log.debug('Transaction check raised an exception', exc_info = True)
+        return False
+
+def verify_many(transactions, sender_balances, sender_previous_nonces):
+    '''
+    Verify many independent transactions (e.g. a mempool) with the checks of Transaction.verify_bool.
+    The balance, nonce and other cheap checks run serially first; only the ECDSA verifications of the transactions passing them are spread over a thread pool.
+
+    PARAMETERS:
+    transactions (list) - transactions to verify
+    sender_balances (list) - spender funds available to spend, for each transaction
+    sender_previous_nonces (list) - nonce from previoius transaction by the spender, for each transaction
+
+    OUTPUT:
+    list of booleans (True if valid), in the order of transactions; a transaction whose checks raise is reported as invalid rather than aborting the batch
+    '''
 
-            #generate a hash of the message supposed to have been signed 
-            msg_hash = sha256_hash([self.recipient_hash, self.amount.to_bytes(8,'little'), self.fee.to_bytes(8,'little'), self.nonce.to_bytes(8,'little')])
-            #deserialize public key
-            decoded_public_key = pk_serialize(self.sender_public_key, encode_type = 'des')
-            #verify that ECDSA signature was signed with sender's secret key on the hashed message by unlocking with the sender's public key
-            decoded_public_key.verify(self.signature, msg_hash, ec.ECDSA(utils.Prehashed(hashes.SHA256()))), 'Invalid Signature'
-            
-            #print(f'Transaction {self.txid.hex()} succesfully created')
+    prechecks = [_passes_prechecks(t, b, n) for t, b, n in zip(transactions, sender_balances, sender_previous_nonces)]
+    prechecked = [t for t, passed in zip(transactions, prechecks) if passed]
 
-            return True
-            
-        except AssertionError as e:
-            print(f'Transaction {self.txid.hex()} unsuccesful: {e}')
-            raise #throw AssertionError exception (break the code runtime)
+    #a single transaction is not worth the hand-off to the thread pool
+    if len(prechecked) < 2:
+        ecdsa_results = [_passes_ecdsa(t) for t in prechecked]
+    else:
+        _share_decoded_public_keys(prechecked)
+        ecdsa_results = _signature_executor.map(_passes_ecdsa, prechecked)
 
-        except InvalidSignature:
-            print(f'Transaction {self.txid.hex()} unsuccesful: Invalid Signature')
-            raise
+    #transactions failing a cheap check are invalid; the others take the result of their ECDSA verification, in order
+    ecdsa_results = iter(ecdsa_results)
+    return [passed and next(ecdsa_results) for passed in prechecks]
 
 #--------------------------------------------
 ##### CREATE TRANSACTION FUNCTION #####
@@ -118,18 +423,21 @@ def create_signed_transaction(sender_secret_key, recipient_hash, amount, fee, no
     nonce (int) - sender transaction sequence number
     '''
 
-    #generate sender public key from elliptic curve secret key 
+    #generate sender public key from elliptic curve secret key (serialized once, for both the address and the txid)
     sender_public_key = sender_secret_key.public_key()
+    serialized_public_key = pk_serialize(sender_public_key)
     #generate sender address (sha1 hash of public key)
-    sender_hash = generate_address(sender_public_key)
+    sender_hash = generate_address(serialized_public_key)
 
     #sign transaction message with sender's secret key
     signature = generate_signature(sender_secret_key, recipient_hash, amount, fee, nonce)
 
     #generate transaction id 
-    txid = sha256_hash([sender_hash, recipient_hash, pk_serialize(sender_public_key), amount.to_bytes(8,'little'), fee.to_bytes(8,'little'), nonce.to_bytes(8,'little'), signature]) #public_key is serialized prior to hashing
+    packed_fields = TRANSACTION_FIELDS.pack(amount, fee, nonce)
+    txid = sha256_hash(sender_hash, recipient_hash, serialized_public_key, packed_fields, signature) #public_key is serialized prior to hashing; amount, fee, nonce are 8-byte little endian
 
-    #create Transaction instance
-    transaction = Transaction(sender_hash, recipient_hash, sender_public_key, amount, fee, nonce, signature, txid)
+    #create Transaction instance (the verifying key is built from the key object, so verifying it needs no DER decode)
+    transaction = Transaction(sender_hash, recipient_hash, serialized_public_key, amount, fee, nonce, signature, txid)
+    transaction._decoded_pk = (serialized_public_key, load_verifying_key(sender_public_key))
 
     return transaction